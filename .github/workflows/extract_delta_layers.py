@@ -12,6 +12,10 @@ belong to the base image vs. which layers were added in the built image.
 The extracted layer blobs are saved with an index prefix (01_, 02_, etc.) to 
 preserve their original order for later extraction.
 
+The image is streamed from the Docker daemon straight into Python's tarfile 
+module, no temporary image tarball is written. Only the delta layer blobs 
+ever touch the disk.
+
 Usage:
     python3 extract_delta_layers.py BASE_IMAGE BUILT_IMAGE [OPTIONS]
 
@@ -27,16 +31,104 @@ Options:
 
 import argparse
 import docker
+import errno
+import io
 import json
 import logging
 import os
 import sys
-import subprocess
-import tempfile
+import tarfile
 import shutil
+from contextlib import closing, suppress
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import IO, Iterator, List, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Chunk size requested from the daemon for the docker save stream
+SAVE_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Read size used when pulling the image stream through tarfile
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+# History fields kept in the extraction report
+HISTORY_REPORT_FIELDS = ('Created', 'CreatedBy', 'Size')
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only file object over the chunk generator of a docker save stream."""
+    
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = memoryview(b'')
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+    
+    def close(self) -> None:
+        # Closing the generator releases the HTTP response from the daemon
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        super().close()
+
+
+def _iter_stream_members(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """Iterate over a stream-mode tar without keeping every TarInfo around."""
+    while True:
+        member = tar.next()
+        if member is None:
+            return
+        # Stream mode can't seek back anyway, so the member list is only dead weight
+        tar.members.clear()
+        yield member
+
+
+def _copy_file(src: str, dst: str) -> None:
+    """Copy src to dst inside the kernel with os.copy_file_range.
+    
+    On filesystems with reflink support (btrfs, xfs) this clones the file
+    without writing any data. Falls back to shutil.copyfile where
+    copy_file_range is unavailable or not supported for the given files.
+    """
+    try:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                src_stat = os.fstat(fsrc.fileno())
+                remaining = src_stat.st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            os.chmod(dst, src_stat.st_mode)
+        except AttributeError:
+            # os.copy_file_range only exists on Linux
+            shutil.copyfile(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            shutil.copyfile(src, dst)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(dst)
+        raise
 
 
 class DockerLayerExtractor:
@@ -66,8 +158,26 @@ class DockerLayerExtractor:
         # Create output directory
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
+    def is_base_image_current(self) -> bool:
+        """Check whether the local base image matches the registry's digest."""
+        try:
+            local_digests = self.docker_client.api.inspect_image(self.base_image).get('RepoDigests') or []
+        except docker.errors.ImageNotFound:
+            return False
+        
+        distribution = self.docker_client.api.inspect_distribution(self.base_image)
+        remote_digest = distribution.get('Descriptor', {}).get('digest')
+        return any(digest.split('@', 1)[-1] == remote_digest for digest in local_digests)
+    
     def pull_base_image(self) -> None:
         """Pull the base image to ensure we have the latest version for comparison."""
+        try:
+            if self.is_base_image_current():
+                self.logger.info(f"Base image {self.base_image} is up to date, skipping pull")
+                return
+        except Exception as e:
+            self.logger.debug(f"Could not compare base image digests: {e}")
+        
         self.logger.info(f"Pulling base image: {self.base_image}")
         try:
             self.docker_client.images.pull(self.base_image)
@@ -79,10 +189,8 @@ class DockerLayerExtractor:
     def get_image_layers(self, image_identifier: str) -> List[str]:
         """Get the list of layer IDs for an image."""
         try:
-            image = self.docker_client.images.get(image_identifier)
-            
-            # Get the RootFS layers from image inspection
-            inspect_data = self.docker_client.api.inspect_image(image.id)
+            # Get the RootFS layers from image inspection, the API resolves tags itself
+            inspect_data = self.docker_client.api.inspect_image(image_identifier)
             layers = inspect_data.get('RootFS', {}).get('Layers', [])
             
             self.logger.debug(f"Image {image_identifier} has {len(layers)} layers")
@@ -95,8 +203,7 @@ class DockerLayerExtractor:
     def get_image_history(self, image_identifier: str) -> List[Dict]:
         """Get the history of an image showing layer information."""
         try:
-            image = self.docker_client.images.get(image_identifier)
-            history = self.docker_client.api.history(image.id)
+            history = self.docker_client.api.history(image_identifier)
             
             self.logger.debug(f"Image {image_identifier} history has {len(history)} entries")
             return history
@@ -105,7 +212,7 @@ class DockerLayerExtractor:
             self.logger.error(f"Failed to get history for image {image_identifier}: {e}")
             return []
     
-    def identify_delta_layers(self) -> Tuple[List[str], List[Dict]]:
+    def identify_delta_layers(self) -> Tuple[List[str], List[str], List[Dict]]:
         """Identify which layers are new (delta) compared to the base image."""
         self.logger.info("Identifying delta layers...")
         
@@ -119,7 +226,8 @@ class DockerLayerExtractor:
         
         # Simple logic: remove base layers from built layers to get delta layers
         base_layers_set = set(base_layers)
-        delta_layers = [layer for layer in built_layers if layer not in base_layers_set]
+        built_layer_flags = [(layer, layer not in base_layers_set) for layer in built_layers]
+        delta_layers = [layer for layer, is_delta in built_layer_flags if is_delta]
         
         # Get corresponding history entries for delta layers
         # History is in reverse chronological order (newest first)
@@ -127,121 +235,167 @@ class DockerLayerExtractor:
         
         self.logger.info(f"Found {len(delta_layers)} delta layers")
         
-        if self.verbose:
-            self.logger.debug("Base layers:")
-            for i, layer in enumerate(base_layers):
-                self.logger.debug(f"  Base layer {i+1}: {layer[:12]}...")
+        # A layer can repeat within an image, it must still be applied at every
+        # position but its blob is only streamed once and copied for the rest
+        repeated_layers = len(delta_layers) - len(set(delta_layers))
+        if repeated_layers:
+            self.logger.info(f"{repeated_layers} delta layers repeat an earlier delta layer")
+        
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Format each section in one go rather than one debug call per layer
+            lines = ["Base layers:"]
+            lines.extend(f"  Base layer {i+1}: {layer[:12]}..." for i, layer in enumerate(base_layers))
+            self.logger.debug("\n".join(lines))
             
-            self.logger.debug("Built layers:")
-            for i, layer in enumerate(built_layers):
-                is_delta = layer not in base_layers_set
-                self.logger.debug(f"  Built layer {i+1}: {layer[:12]}... {'(DELTA)' if is_delta else '(FROM BASE)'}")
+            lines = ["Built layers:"]
+            for i, (layer, is_delta) in enumerate(built_layer_flags):
+                lines.append(f"  Built layer {i+1}: {layer[:12]}... {'(DELTA)' if is_delta else '(FROM BASE)'}")
+            self.logger.debug("\n".join(lines))
             
-            self.logger.debug("Delta layers found:")
+            lines = ["Delta layers found:"]
             for i, layer in enumerate(delta_layers):
-                self.logger.debug(f"  Delta layer {i+1}: {layer[:12]}...")
+                lines.append(f"  Delta layer {i+1}: {layer[:12]}...")
                 if i < len(delta_history):
                     created_by = delta_history[i].get('CreatedBy', 'Unknown')
                     size = delta_history[i].get('Size', 0)
-                    self.logger.debug(f"    Created by: {created_by}")
-                    self.logger.debug(f"    Size: {size} bytes")
+                    lines.append(f"    Created by: {created_by}")
+                    lines.append(f"    Size: {size} bytes")
+            self.logger.debug("\n".join(lines))
         
-        return delta_layers, delta_history
+        return delta_layers, built_layers, delta_history
+    
+    def map_layer_outputs(self, layer_files: List[Tuple[int, str]], layers_dir: Path) -> Dict[str, List[Tuple[int, str]]]:
+        """Map tar member names to the output paths of their (delta position, file) pairs."""
+        layers_dir_str = str(layers_dir)
+        wanted_layers: Dict[str, List[Tuple[int, str]]] = {}
+        for i, layer_file in layer_files:
+            layer_name = layer_file.replace('/', '_')
+            indexed_layer_name = f"{i+1:02d}_{layer_name}.tar"
+            wanted_layers.setdefault(layer_file, []).append((i, os.path.join(layers_dir_str, indexed_layer_name)))
+        return wanted_layers
     
-    def save_image_as_tar(self) -> str:
-        """Save the built image as a tar file for layer extraction."""
-        tar_path = self.output_dir / f"{self.built_image.replace(':', '_').replace('/', '_')}.tar"
+    def write_layer_blob(self, source: IO[bytes], output_path: str) -> None:
+        """Write a layer blob from the image stream to disk."""
+        try:
+            with open(output_path, 'wb') as f:
+                shutil.copyfileobj(source, f, STREAM_BUFFER_SIZE)
+        except BaseException:
+            # Don't leave a truncated blob behind
+            with suppress(OSError):
+                os.unlink(output_path)
+            raise
+    
+    def stream_image(self, wanted_layers: Dict[str, List[Tuple[int, str]]],
+                     extracted_layers: Dict[int, str]) -> Optional[Dict]:
+        """Stream the saved image once and write the wanted layer blobs.
         
-        self.logger.info(f"Saving image to tar file: {tar_path}")
+        manifest.json is buffered along the way, in case the wanted member
+        names turn out not to match the image layout. Written members are
+        removed from wanted_layers and reading stops as soon as it is empty,
+        closing the stream tells the daemon to stop serializing the rest of
+        the image.
+        """
+        manifest = None
         
-        try:
-            image = self.docker_client.images.get(self.built_image)
-            
-            # Save image to tar
-            with open(tar_path, 'wb') as f:
-                for chunk in image.save():
-                    f.write(chunk)
-            
-            self.logger.info(f"Image saved to: {tar_path}")
-            return str(tar_path)
-            
-        except Exception as e:
-            self.logger.error(f"Failed to save image as tar: {e}")
-            return None
+        chunks = self.docker_client.api.get_image(self.built_image, chunk_size=SAVE_CHUNK_SIZE)
+        with closing(_ChunkStream(chunks)) as stream:
+            with tarfile.open(fileobj=stream, mode='r|', bufsize=STREAM_BUFFER_SIZE) as tar:
+                for member in _iter_stream_members(tar):
+                    if not member.isfile():
+                        continue
+                    
+                    if member.name == 'manifest.json':
+                        manifest = json.load(tar.extractfile(member))[0]  # Usually contains one entry
+                    
+                    if member.name not in wanted_layers:
+                        continue
+                    
+                    outputs = wanted_layers.pop(member.name)
+                    
+                    _, first_path = outputs[0]
+                    self.write_layer_blob(tar.extractfile(member), first_path)
+                    for _, output_layer_path in outputs[1:]:
+                        _copy_file(first_path, output_layer_path)
+                    
+                    for i, output_layer_path in outputs:
+                        extracted_layers[i] = output_layer_path
+                        self.logger.debug(f"Extracted delta layer {i+1}: {os.path.basename(output_layer_path)}")
+                    
+                    if not wanted_layers:
+                        break
+        
+        return manifest
     
-    def extract_layers_from_tar(self, tar_path: str, delta_layers: List[str]) -> List[str]:
-        """Extract delta layers from the saved tar file."""
-        self.logger.info("Extracting delta layers from tar file...")
+    def extract_delta_layers(self, delta_layers: List[str], built_layers: List[str]) -> List[str]:
+        """Extract delta layers by streaming the saved image straight into tarfile.
+        
+        Images saved in the OCI layout by the classic image store (Docker 25+)
+        name uncompressed layer blobs by their digest, which is the diff_id we
+        already know, so a single pass is enough. Other layouts (legacy IDs,
+        compressed blobs from the containerd image store) are mapped through
+        manifest.json, read during the first pass, and written during a second
+        one. The full image tar never hits the disk.
+        """
+        self.logger.info("Extracting delta layers from image stream...")
         
-        extracted_layers = []
+        extracted_layers = {}
         
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Extract the tar file
-                subprocess.run(['tar', '-xf', tar_path, '-C', temp_dir], check=True)
+            # Create layers output directory
+            layers_dir = self.output_dir / 'layers'
+            layers_dir.mkdir(exist_ok=True)
+            
+            # Try the OCI blob names first
+            oci_layer_files = [f"blobs/sha256/{layer.split(':', 1)[-1]}" for layer in delta_layers]
+            wanted_layers = self.map_layer_outputs(list(enumerate(oci_layer_files)), layers_dir)
+            manifest = self.stream_image(wanted_layers, extracted_layers)
+            
+            if wanted_layers:
+                self.logger.debug("Layer blobs are not named by digest, falling back to manifest.json")
                 
-                # Read the manifest.json to understand the structure
-                manifest_path = Path(temp_dir) / 'manifest.json'
-                if not manifest_path.exists():
+                if manifest is None:
                     self.logger.error("No manifest.json found in image tar")
+                    # The report won't list blobs the first pass already wrote
+                    for output_layer_path in extracted_layers.values():
+                        with suppress(OSError):
+                            os.unlink(output_layer_path)
                     return []
                 
-                with open(manifest_path, 'r') as f:
-                    manifest = json.load(f)[0]  # Usually contains one entry
-                
                 image_layers = manifest.get('Layers', [])
                 
-                # Create layers output directory
-                layers_dir = self.output_dir / 'layers'
-                layers_dir.mkdir(exist_ok=True)
+                # We need to map the delta layer IDs to the actual layer files in the tar.
+                # RootFS.Layers from the image inspection lists the layers in the same
+                # order as the manifest, so the index of a diff_id there is also the
+                # index of its layer file in the manifest.
+                delta_layer_set = set(delta_layers)
+                built_layer_index = {}
+                for i, built_layer in enumerate(built_layers):
+                    if built_layer in delta_layer_set:
+                        built_layer_index.setdefault(built_layer, i)
                 
-                # We need to map the delta layer IDs to the actual layer files in the tar
-                # The manifest contains layer files, but we need to identify which ones
-                # correspond to our delta layers
+                # Map delta layer IDs to manifest layer files, skipping the
+                # positions the first pass already wrote
+                delta_layer_files = []
+                for position, delta_layer in enumerate(delta_layers):
+                    if position in extracted_layers:
+                        continue
+                    i = built_layer_index.get(delta_layer)
+                    if i is not None and i < len(image_layers):
+                        delta_layer_files.append((position, image_layers[i]))
+                        self.logger.debug(f"Mapped delta layer {delta_layer[:12]}... to file {image_layers[i]}")
                 
-                # Read the config to get layer mapping
-                config_file = manifest.get('Config')
-                if config_file:
-                    config_path = Path(temp_dir) / config_file
-                    if config_path.exists():
-                        with open(config_path, 'r') as f:
-                            config_data = json.load(f)
-                            
-                        # Get the diff_ids from config which map to our layer IDs
-                        config_layers = config_data.get('rootfs', {}).get('diff_ids', [])
-                        
-                        # Map delta layer IDs to manifest layer files
-                        delta_layer_files = []
-                        for delta_layer in delta_layers:
-                            # Find the index of this layer in config_layers
-                            for i, config_layer in enumerate(config_layers):
-                                if config_layer == delta_layer:
-                                    # This delta layer corresponds to manifest layer at index i
-                                    if i < len(image_layers):
-                                        delta_layer_files.append(image_layers[i])
-                                        self.logger.debug(f"Mapped delta layer {delta_layer[:12]}... to file {image_layers[i]}")
-                                        break
-                        
-                        # Extract only the delta layer files with index prefix
-                        for i, layer_file in enumerate(delta_layer_files):
-                            layer_path = Path(temp_dir) / layer_file
-                            if layer_path.exists():
-                                # Extract this layer to our output directory with index prefix
-                                layer_name = layer_file.replace('/', '_')
-                                indexed_layer_name = f"{i+1:02d}_{layer_name}.tar"
-                                output_layer_path = layers_dir / indexed_layer_name
-                                
-                                shutil.copy2(layer_path, output_layer_path)
-                                extracted_layers.append(str(output_layer_path))
-                                
-                                self.logger.debug(f"Extracted delta layer {i+1}: {indexed_layer_name}")
-                
-                self.logger.info(f"Extracted {len(extracted_layers)} delta layer files")
+                wanted_layers = self.map_layer_outputs(delta_layer_files, layers_dir)
                 
+                # Stream the image again and write only the delta layer files with index prefix
+                if wanted_layers:
+                    self.stream_image(wanted_layers, extracted_layers)
+            
+            self.logger.info(f"Extracted {len(extracted_layers)} delta layer files")
+            
         except Exception as e:
-            self.logger.error(f"Failed to extract layers from tar: {e}")
+            self.logger.error(f"Failed to extract layers from image stream: {e}")
         
-        return extracted_layers
+        return [extracted_layers[i] for i in sorted(extracted_layers)]
     
     def generate_report(self, delta_layers: List[str], delta_history: List[Dict], extracted_files: List[str]) -> None:
         """Generate a summary report of the extraction process."""
@@ -253,13 +407,20 @@ class DockerLayerExtractor:
             'built_image': self.built_image,
             'delta_layers_count': len(delta_layers),
             'delta_layers': delta_layers,
-            'delta_history': delta_history,
+            'delta_history': [
+                {key: entry[key] for key in HISTORY_REPORT_FIELDS if key in entry}
+                for entry in delta_history
+            ],
             'extracted_files': extracted_files,
             'output_directory': str(self.output_dir)
         }
         
-        with open(report_path, 'w') as f:
-            json.dump(report, f, indent=2)
+        if orjson is not None:
+            with open(report_path, 'wb') as f:
+                f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+        else:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
         
         self.logger.info(f"Extraction report saved to: {report_path}")
         
@@ -286,6 +447,7 @@ class DockerLayerExtractor:
                 
                 f.write("\nNote: Layer blobs are prefixed with index (01_, 02_, etc.) to preserve extraction order.\n")
                 f.write("Extract each blob with: tar -xf <blob_file> -C <target_directory>\n")
+                f.write("tar -xf detects gzip or zstd compressed blobs automatically.\n")
             
             self.logger.info(f"Summary report saved to: {summary_path}")
     
@@ -298,27 +460,21 @@ class DockerLayerExtractor:
             self.pull_base_image()
             
             # Step 2: Identify delta layers
-            delta_layers, delta_history = self.identify_delta_layers()
+            delta_layers, built_layers, delta_history = self.identify_delta_layers()
             
             if not delta_layers:
                 self.logger.warning("No delta layers found. The image might be identical to the base image.")
                 return
             
-            # Step 3: Save image as tar
-            tar_path = self.save_image_as_tar()
-            if not tar_path:
-                self.logger.error("Failed to save image as tar")
-                return
-            
-            # Step 4: Extract delta layers
-            extracted_files = self.extract_layers_from_tar(tar_path, delta_layers)
+            # Step 3: Stream the image and extract delta layers
+            extracted_files = self.extract_delta_layers(delta_layers, built_layers)
             
-            # Step 5: Generate report
+            # Step 4: Generate report
             self.generate_report(delta_layers, delta_history, extracted_files)
             
-            # Step 6: Cleanup tar file
-            os.remove(tar_path)
-            self.logger.info("Cleaned up temporary tar file")
+            if len(extracted_files) < len(delta_layers):
+                self.logger.error(f"Extracted only {len(extracted_files)} of {len(delta_layers)} delta layers")
+                sys.exit(1)
             
             self.logger.info(f"Extraction completed successfully! Output in: {self.output_dir}")
             